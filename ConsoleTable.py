@@ -72,6 +72,12 @@ class ConsoleTable:
             return s
     
     def print(self):
+        self.stream(self.rows)
+
+    # Prints the table from any iterable of (row, color) tuples. Rows
+    # are written as they are produced so a generator never has to be
+    # collected into memory before printing.
+    def stream(self, rows):
         separator = False
         if self.print_headers:
             row_list = []
@@ -84,7 +90,7 @@ class ConsoleTable:
             print('|'.join(row_list))
             separator = True
 
-        for row_data in self.rows:
+        for row_data in rows:
             if separator:
                 print('-'*self.get_width())
             else:
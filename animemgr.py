@@ -1,12 +1,31 @@
 #!/usr/bin/env python3
-import json, os, math, optparse, requests, re, time, ConsoleTable
+import json, os, sys, math, optparse, requests, re, time, fcntl, hashlib, ConsoleTable
 from ConsoleTable import ConsoleTable as cTable, ConsoleTableColumn as cColumn
 from os.path import exists
 from datetime import datetime
+from contextlib import contextmanager
+from email.utils import formatdate
+from xml.sax.saxutils import escape as xml_escape
 
 SECONDS_IN_HOUR = 3600
 SECONDS_IN_DAY = 86400
 JSON_FILE_PATH = f"{os.path.expanduser('~')}/.animelog"
+INDEX_FILE_PATH = f"{JSON_FILE_PATH}.index"
+
+# Named profiles are stored as one shard per profile. Show metadata from
+# MyAnimeList.net is kept once in a catalog shared by the named profiles.
+# Their shards hold no metadata of their own, so the catalog is primary
+# data and not a cache. The default profile keeps its records whole.
+PROFILE_DIR = f"{JSON_FILE_PATH}.d"
+CATALOG_FILE_PATH = f"{PROFILE_DIR}/catalog"
+CATALOG_FIELDS = ('name', 'alternative_titles', 'episodes', 'start_date')
+
+# Options a new profile copies from the default profile.
+PROFILE_SHARED_OPTIONS = ('apikey', 'timezone', 'extensions')
+
+# File extensions counted as episodes when auto-updating. This can be
+# overridden with the 'extensions' option.
+VIDEO_EXTENSIONS = ('mkv', 'mp4', 'avi', 'webm', 'm4v', 'mov', 'wmv', 'ts')
 
 class Anime:
     STATUS_PENDING = 'Pending'
@@ -25,7 +44,7 @@ class Anime:
         self.alt_title = data['alt_title'] if 'alt_title' in data.keys() else ''
 
         if len(self.folder) > 0 and exists(self.folder) and self.auto:
-            count = len([name for name in os.listdir(self.folder) if os.path.isfile(f"{self.folder}/{name}")])
+            count = len([ep for ep in self.get_episodes().keys() if ep != None])
             if count != self.downloaded:
                 self.downloaded = count
                 self.modified = True
@@ -38,7 +57,7 @@ class Anime:
                 self.start_date = data['start_date']
 
         if verbose:
-            print(f'Anime object instantiated: {self.to_dict()}')
+            print(f'Anime object instantiated: {self.to_dict()}', file=sys.stderr)
 
         self.released = self.get_released()
         self.next_episode = self.get_next_date()
@@ -50,6 +69,24 @@ class Anime:
             out[attr] = val
         return out
     
+    # Returns a dictionary of episode number -> file names found in the
+    # anime's folder. Files with no recognisable episode number are
+    # listed under None.
+    def get_episodes(self) -> dict:
+        if len(self.folder) == 0 or not exists(self.folder):
+            return {}
+
+        episodes = get_episode_index().scan(self.folder)
+
+        # Single episode releases (i.e. movies) rarely carry a number.
+        if self.episodes == 1 and None in episodes.keys() and 1 not in episodes.keys():
+            episodes[1] = episodes.pop(None)
+        return episodes
+
+    def get_missing(self) -> list:
+        episodes = self.get_episodes()
+        return [ep for ep in range(1, self.released + 1) if ep not in episodes.keys()]
+
     def get_display_title(self) -> str:
         return self.alternative_titles[self.alt_title] if self.alt_title != "" and self.alt_title in self.alternative_titles.keys() else self.name
 
@@ -119,28 +156,345 @@ def to_utc(stamp: float, tz: int, daylight_savings=False) -> float:
 def from_utc(stamp: float, tz: int, daylight_savings=False) -> float:
     return stamp + ((tz + daylight_savings) * SECONDS_IN_HOUR)
 
-def load_json(file: str):
-    if verbose:
-        print(f'Loading {file}  data.')
+# Every data file is guarded by a sidecar lock file. Readers take a shared
+# lock so they never block each other, writers take an exclusive lock.
+@contextmanager
+def file_lock(path: str, mode: int):
+    with open(f'{path}.lock', 'a') as lock:
+        fcntl.flock(lock, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def read_json(file: str):
     # If the file exists, load the existing json data
     if exists(file):
-        f = open(file)
-        data = f.read()
+        with open(file) as f:
+            data = f.read()
         # If data is found in the file then return it
         if len(data) > 0:
             return json.loads(data)
+    return None
+
+# Writes to a temporary file and swaps it in so the file is never seen
+# half written.
+def write_json(path: str, data: dict):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as out:
+        out.write(f'{json.dumps(data)}\n')
+    os.replace(tmp, path)
+
+def load_json(file: str):
+    if verbose:
+        print(f'Loading {file}  data.')
+
+    with file_lock(file, fcntl.LOCK_SH):
+        data = read_json(file)
+        if data != None and is_shard(file):
+            hydrate(data, file)
+    if data != None:
+        return data
     
     print(f'Failed to load {file}. Loading empty configuration')
     # As a last resort, return blank json data.
-    return {"anime": [], "autoclean": False, "apikey": None, "timezone": TZ_CST}
+    return empty_config()
 
-def save_json(data: dict, path: str):
+def empty_config() -> dict:
+    return {"anime": [], "autoclean": False, "apikey": None, "timezone": TZ_CST, "generation": 0}
+
+# Saves the data using optimistic concurrency. The file carries a generation
+# counter which is bumped on every write. If the generation on disk no longer
+# matches the one that was loaded then another process has written in the
+# meantime, so the data is reloaded and the edit callback is re-applied to it
+# instead of overwriting the other process' changes.
+def save_json(data: dict, path: str, edit=None) -> bool:
     if verbose:
         print(f'Saving data...')
 
-    with open(path, 'w') as out:
-        out.write(f'{json.dumps(data)}\n')
-        print(f"Wrote {len(str(data).encode('utf-8'))} bytes to file.")
+    with file_lock(path, fcntl.LOCK_EX):
+        current = read_json(path)
+        generation = current.get('generation', 0) if current != None else 0
+
+        if data.get('generation', 0) != generation:
+            if edit == None:
+                print(f'{path} was changed by another process. Changes were not saved.')
+                return False
+
+            if verbose:
+                print(f'{path} was changed by another process. Re-applying changes.')
+            # The file may have been removed since it was loaded, in which
+            # case the edit is applied to an empty configuration.
+            data.clear()
+            data.update(current if current != None else empty_config())
+            if is_shard(path):
+                hydrate(data, path)
+            edit(data)
+
+        data['generation'] = generation + 1
+
+        out = data
+        if is_shard(path):
+            store_catalog(data['anime'], path)
+            out = dehydrate(data)
+        elif exists(PROFILE_DIR):
+            seed_catalog(data['anime'])
+
+        write_json(path, out)
+        with file_lock(f'{path}.idx', fcntl.LOCK_EX):
+            write_json(f'{path}.idx', build_profile_index(data))
+        print(f"Wrote {len(str(out).encode('utf-8'))} bytes to file.")
+    return True
+
+### PROFILE CODE
+json_file_path = JSON_FILE_PATH
+def get_profile_path(name: str) -> str:
+    if name == None or name == 'default':
+        return JSON_FILE_PATH
+    return f'{PROFILE_DIR}/{name}.json'
+
+def get_profiles() -> dict:
+    profiles = {}
+    if exists(JSON_FILE_PATH):
+        profiles['default'] = JSON_FILE_PATH
+    if exists(PROFILE_DIR):
+        for name in sorted(os.listdir(PROFILE_DIR)):
+            if name.endswith('.json'):
+                profiles[name[:-len('.json')]] = f'{PROFILE_DIR}/{name}'
+    return profiles
+
+def is_shard(path: str) -> bool:
+    return os.path.dirname(path) == PROFILE_DIR
+
+def load_profile(name: str) -> dict:
+    path = get_profile_path(name)
+    if path == JSON_FILE_PATH or exists(path):
+        return load_json(path)
+
+    # A new profile starts with the options of the default profile.
+    if verbose:
+        print(f'Creating profile {name}.')
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    data = {"anime": [], "autoclean": False, "apikey": None, "timezone": TZ_CST, "generation": 0}
+    if exists(JSON_FILE_PATH):
+        default = load_json(JSON_FILE_PATH)
+        for key in PROFILE_SHARED_OPTIONS:
+            if key in default.keys():
+                data[key] = default[key]
+    return data
+
+def load_catalog() -> dict:
+    if not exists(PROFILE_DIR):
+        return {}
+    with file_lock(CATALOG_FILE_PATH, fcntl.LOCK_SH):
+        return read_json(CATALOG_FILE_PATH) or {}
+
+# The catalog entries as they were merged into each loaded profile. Saves
+# compare against these so only metadata that was actually changed is
+# written back to the catalog.
+catalog_snapshots = {}
+
+# Fills in the show metadata of each record in a shard from the catalog.
+def hydrate(data: dict, path: str):
+    catalog = load_catalog()
+    snapshot = catalog_snapshots.setdefault(path, {})
+    for record in data['anime']:
+        if str(record['id']) in catalog.keys():
+            record.update(catalog[str(record['id'])])
+            snapshot[str(record['id'])] = dict(catalog[str(record['id'])])
+
+# Returns a copy of the data with the show metadata left out of each record
+# since it is stored in the catalog.
+def dehydrate(data: dict) -> dict:
+    out = dict(data)
+    out['anime'] = [{key: val for key, val in record.items() if key not in CATALOG_FIELDS} for record in data['anime']]
+    return out
+
+def store_catalog(records: list, path: str):
+    snapshot = catalog_snapshots.setdefault(path, {})
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with file_lock(CATALOG_FILE_PATH, fcntl.LOCK_EX):
+        catalog = read_json(CATALOG_FILE_PATH) or {}
+        changed = False
+        for record in records:
+            id = str(record['id'])
+            loaded = snapshot.get(id, {})
+
+            # Metadata another profile synced since this data was loaded
+            # must not be reverted, so only the fields this save changed
+            # are merged into the current entry.
+            changes = {key: record[key] for key in CATALOG_FIELDS if key in record.keys() and loaded.get(key) != record[key]}
+            entry = {**catalog.get(id, {}), **changes}
+            if catalog.get(id) != entry:
+                catalog[id] = entry
+                changed = True
+            if id in catalog.keys():
+                snapshot[id] = dict(catalog[id])
+
+        if changed:
+            write_json(CATALOG_FILE_PATH, catalog)
+
+# The default profile adds shows the catalog does not know yet so named
+# profiles do not have to fetch them again. It never overwrites existing
+# entries, as those may have been synced by a named profile.
+def seed_catalog(records: list):
+    with file_lock(CATALOG_FILE_PATH, fcntl.LOCK_EX):
+        catalog = read_json(CATALOG_FILE_PATH) or {}
+        changed = False
+        for record in records:
+            if str(record['id']) not in catalog.keys():
+                catalog[str(record['id'])] = {key: record[key] for key in CATALOG_FIELDS if key in record.keys()}
+                changed = True
+
+        if changed:
+            write_json(CATALOG_FILE_PATH, catalog)
+
+def catalog_lookup(id: int) -> Anime:
+    if not exists(CATALOG_FILE_PATH):
+        return None
+
+    catalog = load_catalog()
+    if str(id) not in catalog.keys():
+        return None
+
+    if verbose:
+        print(f'Found anime {id} in the catalog.')
+    return Anime({'id': id, **catalog[str(id)]})
+
+# Each profile keeps a small index next to it so that questions across
+# profiles can be answered without loading every profile in full.
+def build_profile_index(data: dict) -> dict:
+    index = {}
+    for record in data['anime']:
+        index[str(record['id'])] = {key: record[key] for key in ('downloaded', 'episodes', 'start_date') if key in record.keys()}
+    return index
+
+def load_profile_index(path: str) -> dict:
+    with file_lock(path, fcntl.LOCK_SH):
+        index = read_json(f'{path}.idx')
+    if index != None:
+        return index
+
+    # Profiles saved before indexes existed are loaded once in full and
+    # their index is written so later queries can use it. The profile is
+    # only read, so other readers are not blocked.
+    with file_lock(path, fcntl.LOCK_SH):
+        data = read_json(path) or {"anime": []}
+        if is_shard(path):
+            hydrate(data, path)
+    index = build_profile_index(data)
+
+    # A save may have written a newer index in the meantime, in which case
+    # it is kept.
+    with file_lock(f'{path}.idx', fcntl.LOCK_EX):
+        if not exists(f'{path}.idx'):
+            write_json(f'{path}.idx', index)
+    return index
+
+def list_behind(id: int):
+    catalog = load_catalog() if exists(CATALOG_FILE_PATH) else {}
+
+    table = cTable()
+    table.add_column(cColumn(header='Profile', width=TABLE_WIDTH_NAME))
+    table.add_column(cColumn(header='D/R', width=TABLE_WIDTH_DR))
+    table.add_column(cColumn(header='Behind', width=TABLE_WIDTH_DR))
+
+    found = False
+    for name, path in get_profiles().items():
+        entry = load_profile_index(path).get(str(id))
+        if entry == None:
+            continue
+        found = True
+
+        # Prefer the shared catalog as it holds the most recently synced metadata.
+        anime = Anime({'id': id, **entry, **catalog.get(str(id), {})})
+        behind = max(anime.released - anime.downloaded, 0)
+        color = '\033[31m' if behind > 0 else '\033[32m'
+        table.add_row((name, f'{anime.downloaded}/{anime.released}', behind), color)
+
+    if not found:
+        print(f'No profile is tracking anime {id}.')
+        return
+    table.print()
+
+# Patterns used to find the episode number in a release file name, most
+# specific first.
+EPISODE_PATTERNS = (
+    re.compile(r'S\d{1,2}E(\d{1,4})', re.I),                      # Show S01E05
+    re.compile(r'\s-\s(\d{1,4})(?:v\d)?\b'),                       # [Group] Show - 05v2
+    re.compile(r'\b(?:Episode|Ep|E)[\s._-]*(\d{1,4})(?:v\d)?\b', re.I), # Show Episode 5, Show EP05
+    re.compile(r'[\[(](\d{1,4})(?:v\d)?[\])]'),                     # Show [05]
+    re.compile(r'(?:^|[\s._])(\d{1,4})(?:v\d)?(?=$|[\s._])'),        # Show.05
+)
+
+# Release tags that look like numbers but are not episode numbers.
+EPISODE_NOISE = re.compile(r'\[[0-9A-F]{8}\]|[\[(](?:19|20)\d{2}[\])]|\b\d{3,4}[pi]\b|\b\d{3,4}x\d{3,4}\b|\b[xh]\.?26[45]\b|\b\d{1,2}bit\b|\b(?:AAC|FLAC|AC3|DDP?|Opus)\d?(?:\.\d)?\b', re.I)
+
+def parse_episode(name: str):
+    name = EPISODE_NOISE.sub(' ', os.path.splitext(name)[0])
+    for pattern in EPISODE_PATTERNS:
+        matches = pattern.findall(name)
+        if len(matches) > 0:
+            # The last number is the episode, earlier ones tend to be part of the title.
+            return int(matches[-1])
+    return None
+
+# Caches the episode number parsed from each file so that rescanning a
+# folder only parses files that are new or have changed since the last scan.
+class EpisodeIndex:
+    def __init__(self, path: str, extensions=VIDEO_EXTENSIONS) -> None:
+        self.path = path
+        # Extensions may be given as a list or as a space separated string.
+        if type(extensions) is str:
+            extensions = extensions.split()
+        self.extensions = set([ext.lower().lstrip('.') for ext in extensions])
+        self.changed = False
+
+        # folder -> file name -> [mtime, episode]
+        with file_lock(path, fcntl.LOCK_SH):
+            self.folders = read_json(path) or {}
+
+    def scan(self, folder: str) -> dict:
+        cached = self.folders.get(folder, {})
+        files = {}
+        with os.scandir(folder) as it:
+            for entry in it:
+                if not entry.is_file() or os.path.splitext(entry.name)[1].lower().lstrip('.') not in self.extensions:
+                    continue
+
+                mtime = entry.stat().st_mtime
+                if entry.name in cached.keys() and cached[entry.name][0] == mtime:
+                    files[entry.name] = cached[entry.name]
+                else:
+                    if verbose:
+                        print(f'Indexing {folder}/{entry.name}', file=sys.stderr)
+                    files[entry.name] = [mtime, parse_episode(entry.name)]
+                    self.changed = True
+
+        # Files that were removed also invalidate the cached folder.
+        if len(files) != len(cached):
+            self.changed = True
+        self.folders[folder] = files
+
+        episodes = {}
+        for name, (mtime, ep) in files.items():
+            episodes.setdefault(ep, []).append(name)
+        return episodes
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+
+        with file_lock(self.path, fcntl.LOCK_EX):
+            write_json(self.path, self.folders)
+        self.changed = False
+
+episode_index = None
+def get_episode_index() -> EpisodeIndex:
+    global episode_index
+    if episode_index == None:
+        episode_index = EpisodeIndex(INDEX_FILE_PATH)
+    return episode_index
 
 def get_anime_index(data: dict, id: int, silent: int = False) -> int:
     # Iterate until the anime is found by id
@@ -157,7 +511,8 @@ def get_anime_index(data: dict, id: int, silent: int = False) -> int:
     return -1
 
 def add_anime(data: dict, id: int):
-    anime = api_lookup(data['apikey'], id)
+    # Shows already tracked by another profile do not need to be fetched again.
+    anime = catalog_lookup(id) or api_lookup(data['apikey'], id)
     
     inpt = ''
     # Get confirmation that the correct anime was found.
@@ -178,18 +533,20 @@ def add_anime(data: dict, id: int):
     if verbose:
         print(f'Checking if anime "{anime.name}" is duplicate.')
     # Verify that the anime doesn't already exist
-    i = 0
-    for test in data['anime']:
-        if test["id"] == anime.id:
-            print("This anime is already in the system.")
-            return
+    if get_anime_index(data, anime.id, silent=True) != -1:
+        print("This anime is already in the system.")
+        return
     
     if verbose:
         print(f'Registering new anime: {anime.name}')
 
-    data["anime"].append(anime.to_dict())
+    record = anime.to_dict()
+    def edit(d: dict):
+        if get_anime_index(d, record['id'], silent=True) == -1:
+            d["anime"].append(record)
 
-    save_json(data, JSON_FILE_PATH)
+    edit(data)
+    save_json(data, json_file_path, edit)
     list_anime(data)
 
 def remove_anime(data: dict, id: int):
@@ -213,11 +570,16 @@ def remove_anime(data: dict, id: int):
         return
     
     # Remove the anime
-    data['anime'].pop(index)
+    def edit(d: dict):
+        i = get_anime_index(d, id, silent=True)
+        if i != -1:
+            d['anime'].pop(i)
+
+    edit(data)
 
     # Tell the user about the removal
     print(f'Successfully removed {anime.name}.')
-    save_json(data, JSON_FILE_PATH)
+    save_json(data, json_file_path, edit)
     list_anime(data) 
 
 def update_anime(data: dict, id: int, update: str):
@@ -236,6 +598,7 @@ def update_anime(data: dict, id: int, update: str):
     # Check each variable to see if it has changed and is not the default value.
     # Default values indicate that the value was not given.
     l = []
+    changes = {}
     instructions = update.split(',')
     for instruction in instructions:
         keyval = instruction.split('=')
@@ -244,7 +607,7 @@ def update_anime(data: dict, id: int, update: str):
 
         if hasattr(anime, keyval[0]):
             l.append(f'{keyval[0]}: \033[31m{getattr(anime, keyval[0])}\033[0m -> \033[32m{keyval[1]}\033[0m')
-            setattr(anime, keyval[0], parse_string_value(keyval[1]))
+            changes[keyval[0]] = parse_string_value(keyval[1])
 
     # If a change was actually made then save the data
     if len(l) > 0:
@@ -259,17 +622,52 @@ def update_anime(data: dict, id: int, update: str):
             print('Aborted.')
             return
 
-        data['anime'][index] = anime.to_dict()
-        save_json(data, JSON_FILE_PATH)
+        def edit(d: dict):
+            i = get_anime_index(d, id, silent=True)
+            if i != -1:
+                d['anime'][i].update(changes)
+
+        edit(data)
+        save_json(data, json_file_path, edit)
 
         list_anime(data)
     else:
         print("No changes detected.")
 
-# This function has two loops in it when only one is truly necessary.
-# This is done intentionally for verbose logging purposes. By instantiating
-# all of the anime objects ahead of time, it is possible to alert the user to
-# each change (while verbose) without it interrupting the appearance of the table
+# The anime list is processed as a chain of generators so that only one
+# record is held in memory at a time, no matter how long the list is:
+#   load -> construct -> detect modifications -> render
+def load_records(data: dict):
+    for i in range(0, len(data['anime'])):
+        yield i, data['anime'][i]
+
+def construct_anime(records):
+    for i, record in records:
+        yield i, Anime(record)
+
+def detect_modified(pipeline, modified: list):
+    for i, anime in pipeline:
+        # If the anime object was modified at instantiation
+        # (i.e. auto-updating) then collect it for a deferred save.
+        if anime.modified:
+            # Verbose logs go to stderr so they do not interleave
+            # with the table being streamed to stdout.
+            if verbose:
+                print(f'Detected change in anime {anime.id}.', file=sys.stderr)
+            modified.append(anime)
+        yield anime
+
+def render_rows(pipeline, timezone: int):
+    # The daylight savings flag only needs to be looked up once per listing.
+    dst = time.localtime(datetime.now().timestamp()).tm_isdst
+    for anime in pipeline:
+        # Red if there are unacquired episodes else green
+        color = '\033[31m' if anime.released > anime.downloaded and anime.released > 0 else'\033[32m'
+
+        # Create the string for the next episode date
+        nxt_str = datetime.fromtimestamp(from_utc(anime.next_episode, timezone, dst)).strftime('%Y-%m-%d %H:%M')
+        yield (anime.id, anime.get_display_title(), f'{anime.downloaded}/{anime.released}', anime.episodes, anime.status, nxt_str), color
+
 def list_anime(data: dict):
     table = cTable()
     table.add_column(cColumn(header='id', width=TABLE_WIDTH_ID, justify=ConsoleTable.JUSTIFY_RIGHT))
@@ -279,45 +677,30 @@ def list_anime(data: dict):
     table.add_column(cColumn(header='Status', width=TABLE_WIDTH_STATUS))
     table.add_column(cColumn(header='Fin/Next', width=TABLE_WIDTH_NEXT))
 
-    i = 0
-    changed = False
+    # Only the records that changed are kept around for saving.
+    modified = []
+    pipeline = detect_modified(construct_anime(load_records(data)), modified)
+    table.stream(render_rows(pipeline, data['timezone']))
 
-    # Get all of the anime class objects.
-    anime_list = []
-    for i in range(0, len(data['anime'])):
-        a = Anime(data['anime'][i])
-
-        # If the anime object was modified at instantiation
-        # (i.e. auto-updating) then flag the data to be saved.
-        if a.modified:
-            if verbose:
-                print(f'Detected change in anime {a.id}.')
-            changed = True
-            data['anime'][i] = a.to_dict()
-
-        anime_list.append(a)
-    
     # If there were any changes to any anime objects then
-    # save the json file with the new data.
-    if changed:
-        save_json(data, JSON_FILE_PATH)
-
-    for anime in anime_list:
-        # Red if there are unacquired episodes else green
-        color = '\033[31m' if anime.released > anime.downloaded and anime.released > 0 else'\033[32m'
-
-        # Create the string for the next episode date
-        nxt_str = datetime.fromtimestamp(from_utc(anime.next_episode, data['timezone'], time.localtime(datetime.now().timestamp()).tm_isdst)).strftime('%Y-%m-%d %H:%M')
-        table.add_row((anime.id, anime.get_display_title(), f'{anime.downloaded}/{anime.released}', anime.episodes, anime.status, nxt_str), color)
-        
-    table.print()
+    # save the json file with the new data. Only the auto-updated
+    # counts are written so a concurrent edit is never undone.
+    if len(modified) > 0:
+        downloaded = {anime.id: anime.downloaded for anime in modified}
+        def edit(d: dict):
+            for record in d['anime']:
+                if record['id'] in downloaded:
+                    record['downloaded'] = downloaded[record['id']]
+
+        edit(data)
+        save_json(data, json_file_path, edit)
 
 def print_anime(data: dict, id: int):
     index = get_anime_index(data, id, silent=True)
     if index == -1:
-        anime = api_lookup(data['apikey'], id)
+        anime = catalog_lookup(id) or api_lookup(data['apikey'], id)
         if anime:
-            details(anime=api_lookup(data['apikey'], id), color='\033[32m', timezone=data['timezone'])
+            details(anime=anime, color='\033[32m', timezone=data['timezone'])
         else:
             print(f'Unable to retrieve anime data for anime with id {id}. Please verify that you entered the correct id and try again.')
         return
@@ -329,31 +712,15 @@ def print_anime(data: dict, id: int):
 def clean_list(data: dict):
     print('Cleaning list.')
 
-    # Start an indexer
-    i = 0
-
-    removed=0
-    # Loop until break
+    removed = set()
     print('Searching...')
-    while True:
+    for record in data['anime']:
+        anime = Anime(record)
 
-        # Get the next anime
-        anime = Anime(data['anime'][i])
-
-
-        # If the next anime is complete, remove it from the list
+        # If the anime is complete, mark it for removal
         if anime.downloaded == anime.episodes:
             print(f' - {anime.name}')
-            data['anime'].pop(i)
-            removed += 1
-
-        # If the anime is not complete then move on to the next.
-        else:
-            i+= 1
-
-        # Verify that i is still within index range
-        if i >= len(data['anime']):
-            break
+            removed.add(anime.id)
 
     if not removed:
         print(f'Database already clean.')
@@ -367,8 +734,12 @@ def clean_list(data: dict):
         print('Aborted')
         return
     
-    print(f'Removed {removed} entries')
-    save_json(data)
+    def edit(d: dict):
+        d['anime'] = [record for record in d['anime'] if record['id'] not in removed]
+
+    edit(data)
+    print(f'Removed {len(removed)} entries')
+    save_json(data, json_file_path, edit)
     list_anime(data)
 
 def parse_string_value(s: str):
@@ -390,8 +761,8 @@ def parse_string_value(s: str):
             print(f'Parsed boolean value: False')
         return False
 
-    # integer
-    elif s.isnumeric():
+    # integer (signed, so timezones such as -5 are parsed as numbers)
+    elif re.fullmatch(r'-?\d+', s):
         if verbose:
             print(f'Parsed numeric value: {int(s)}')
         return int(s)
@@ -403,12 +774,14 @@ def parse_string_value(s: str):
         return str(s)
 
 def set_options(data: dict, setopt: dict):
-    for key in setopt.keys():
-        if verbose:
-            print(f'Setting option {key} to -> {setopt[key]}')
-        data[key] = setopt[key]
+    def edit(d: dict):
+        for key in setopt.keys():
+            if verbose:
+                print(f'Setting option {key} to -> {setopt[key]}')
+            d[key] = setopt[key]
     
-    save_json(data)
+    edit(data)
+    save_json(data, json_file_path, edit)
 
 def details(anime: Anime, color='\033[0m', show_settings=False, managed=False, timezone=0):
     print(f'Found {"local" if managed else "remote"} data.')
@@ -425,6 +798,160 @@ def details(anime: Anime, color='\033[0m', show_settings=False, managed=False, t
         print(f'Downloaded: {color}{anime.downloaded}\033[0m')
         print(f'Folder: {color}{anime.folder}\033[0m')
         print(f'Auto Update: {color}{True if anime.auto else False}\033[0m')
+        if len(anime.folder) > 0 and exists(anime.folder):
+            missing = anime.get_missing()
+            print(f'Missing Episodes: {color}{", ".join(map(str, missing)) if len(missing) > 0 else "None"}\033[0m')
+
+### SCHEDULE EXPORT CODE
+EXPORT_FIELDS = ('id', 'name', 'alternative_titles', 'alt_title', 'episodes', 'start_date')
+EXPORT_EPISODE_MINUTES = 30
+
+def ics_escape(s: str) -> str:
+    return str(s).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+# Long content lines are folded as the iCalendar format requires. Lines
+# are limited to 75 octets, so they are measured in UTF-8 bytes and never
+# split inside a multi-byte character. Continuation lines lose one octet
+# to the leading space.
+def ics_fold(line: str) -> str:
+    chunks = ['']
+    size = 0
+    for c in line:
+        n = len(c.encode('utf-8'))
+        if size + n > (75 if len(chunks) == 1 else 74):
+            chunks.append('')
+            size = 0
+        chunks[-1] += c
+        size += n
+    return '\r\n '.join(chunks) + '\r\n'
+
+def get_export_count(anime: Anime) -> int:
+    if anime.start_date == 0:
+        return 0
+    if anime.episodes > 0:
+        return anime.episodes
+
+    # The length is unknown so schedule up to the next airing episode.
+    return round((anime.next_episode - anime.start_date) / (SECONDS_IN_DAY * 7)) + 1
+
+# Feeds only carry episodes that have already aired.
+def get_aired_count(anime: Anime) -> int:
+    return anime.released if anime.episodes > 0 else max(get_export_count(anime) - 1, 0)
+
+def render_ics(anime: Anime, count: int) -> str:
+    stamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    lines = []
+    for ep in range(1, count + 1):
+        # Events are written in UTC so calendars place them correctly on
+        # either side of a daylight savings change.
+        start = anime.start_date + (ep - 1) * SECONDS_IN_DAY * 7
+        end = start + EXPORT_EPISODE_MINUTES * 60
+        lines += [
+            'BEGIN:VEVENT',
+            f'UID:{anime.id}-{ep}@animemgr',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART:{time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(start))}',
+            f'DTEND:{time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(end))}',
+            f'SUMMARY:{ics_escape(anime.get_display_title())} - Episode {ep}',
+            'END:VEVENT',
+        ]
+    return ''.join([ics_fold(line) for line in lines])
+
+def render_rss(anime: Anime, count: int) -> str:
+    items = []
+    for ep in range(1, count + 1):
+        # pubDate is an absolute time so it is formatted from the UTC timestamp.
+        stamp = anime.start_date + (ep - 1) * SECONDS_IN_DAY * 7
+        items.append(
+            '<item>'
+            f'<title>{xml_escape(anime.get_display_title())} - Episode {ep}</title>'
+            f'<guid isPermaLink="false">{anime.id}-{ep}@animemgr</guid>'
+            f'<pubDate>{formatdate(stamp, usegmt=True)}</pubDate>'
+            '</item>\n'
+        )
+    return ''.join(items)
+
+EXPORT_FORMATS = {
+    'ics': (
+        'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//animemgr//EN\r\n',
+        get_export_count,
+        render_ics,
+        'END:VCALENDAR\r\n',
+    ),
+    'rss': (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0"><channel>\n'
+        '<title>Anime Schedule</title><link>https://myanimelist.net</link><description>Episodes of tracked anime</description>\n',
+        get_aired_count,
+        render_rss,
+        '</channel></rss>\n',
+    ),
+}
+
+def get_file_stat(path: str) -> list:
+    if not exists(path):
+        return None
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+# Writes the schedule in the given format. The rendered entries of each
+# anime are cached with a hash of the data they were built from, so only
+# anime whose schedule or metadata changed since the last export are
+# rendered again, and the file is not rewritten at all if nothing changed.
+def export_feed(data: dict, fmt: str, path: str, state: dict):
+    header, get_count, render, footer = EXPORT_FORMATS[fmt]
+
+    # The cache is only valid if the file is still the one written from it.
+    # Another profile exporting to the same path, or any outside change,
+    # causes everything to be rendered again.
+    cached = state['entries'] if state.get('path') == path and get_file_stat(path) == state.get('stat') else {}
+
+    entries = {}
+    rendered = 0
+    for record in data['anime']:
+        # Only the schedule fields are used so auto-updating folders are not scanned.
+        anime = Anime({key: record[key] for key in EXPORT_FIELDS if key in record.keys()})
+        # The count is part of the hash so feeds update as new episodes air.
+        count = get_count(anime)
+
+        key = str(anime.id)
+        digest = hashlib.sha1(json.dumps([[getattr(anime, f) for f in EXPORT_FIELDS], count], sort_keys=True).encode('utf-8')).hexdigest()
+        if key in cached.keys() and cached[key][0] == digest:
+            entries[key] = cached[key]
+        else:
+            if verbose:
+                print(f'Rendering {fmt} entries for anime {anime.id}.')
+            entries[key] = [digest, render(anime, count)]
+            rendered += 1
+
+    if rendered == 0 and len(entries) == len(cached):
+        print(f'{path} is up to date.')
+        return
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', newline='', encoding='utf-8') as out:
+        out.write(header)
+        for key in entries.keys():
+            out.write(entries[key][1])
+        out.write(footer)
+    os.replace(tmp, path)
+
+    state['path'] = path
+    state['stat'] = get_file_stat(path)
+    state['entries'] = entries
+    print(f'Exported {len(entries)} anime to {path} ({rendered} updated).')
+
+def export_schedule(data: dict, ics: str = None, rss: str = None):
+    # Each profile keeps its own export cache.
+    state_path = f'{json_file_path}.export'
+
+    # Exports are serialized so two runs never interleave their cache.
+    with file_lock(state_path, fcntl.LOCK_EX):
+        state = read_json(state_path) or {}
+        for fmt, path in (('ics', ics), ('rss', rss)):
+            if path:
+                export_feed(data, fmt, path, state.setdefault(fmt, {}))
+
+        write_json(state_path, state)
 
 ### API CODE FOR MYANIMELIST
 MYANIMELIST_API_URL = 'https://api.myanimelist.net/v2'
@@ -496,10 +1023,11 @@ def api_sync(data: dict, id: int):
 
     # l will hold a list of attribute changes to be shown.
     l = []    
-    for attr in ('name', 'alternative_titles', 'episodes'):
+    changes = {}
+    for attr in ('name', 'alternative_titles', 'episodes', 'start_date'):
         if getattr(old, attr) != getattr(new, attr):
             l.append(f'  {attr}: \033[31m{getattr(old, attr)}\033[0m -> \033[32m{getattr(new, attr)}\033[0m')
-            setattr(old, attr, getattr(new, attr))
+            changes[attr] = getattr(new, attr)
 
     # If there are no changes then output to user and exit.
     if len(l) == 0:
@@ -521,8 +1049,13 @@ def api_sync(data: dict, id: int):
         print('Aborting.')
         return
 
-    data['anime'][index] = old.to_dict()
-    save_json(data, JSON_FILE_PATH)
+    def edit(d: dict):
+        i = get_anime_index(d, id, silent=True)
+        if i != -1:
+            d['anime'][i].update(changes)
+
+    edit(data)
+    save_json(data, json_file_path, edit)
 
 ### COMMAND EXECUTION CODE
 def execute(options: optparse.OptionParser):
@@ -534,9 +1067,21 @@ def execute(options: optparse.OptionParser):
     if verbose:
         print(f'Verbose logging enabled.')
     
+    if options.profile != None and not re.search(r'^[\w-]+$', options.profile):
+        print(f'Invalid profile name: {options.profile}\nProfile names may only contain letters, numbers, "_" and "-".')
+        return
+
+    global json_file_path
+    json_file_path = get_profile_path(options.profile)
+    data = load_profile(options.profile)
+
+    # Build the episode index with the configured video extensions.
+    global episode_index
+    episode_index = EpisodeIndex(INDEX_FILE_PATH, data['extensions'] if 'extensions' in data.keys() else VIDEO_EXTENSIONS)
+
     # Default to listing if no arguments provided.
     if len(args) == 0 or args[0].lower() == 'list':
-        list_anime(load_json(JSON_FILE_PATH))
+        list_anime(data)
 
     # Printing details of an anime.
     elif args[0].lower() == 'details':
@@ -545,7 +1090,7 @@ def execute(options: optparse.OptionParser):
         elif len(args) > 2:# Too many args
             print('Unable to search: Too many arguments.')
         else:
-            print_anime(load_json(JSON_FILE_PATH), int(args[1]))
+            print_anime(data, int(args[1]))
 
     # Searching MyAnimeList.net for an anime.
     elif args[0].lower() == 'search':
@@ -554,7 +1099,7 @@ def execute(options: optparse.OptionParser):
         elif len(args) > 2:# Too many args
             print('Unable to search: Too many arguments.')
         else:
-            api_search(load_json(JSON_FILE_PATH)['apikey'], args[1])
+            api_search(data['apikey'], args[1])
 
     # Adding an anime to the system.
     elif args[0].lower() == 'add':
@@ -565,7 +1110,7 @@ def execute(options: optparse.OptionParser):
         elif not args[1].isnumeric():
             print('Unable to add: id must be numeric.')
         else:
-            add_anime(load_json(JSON_FILE_PATH), int(args[1]))
+            add_anime(data, int(args[1]))
 
     # Removing an anime from the system.
     elif args[0].lower() == 'remove':
@@ -576,7 +1121,7 @@ def execute(options: optparse.OptionParser):
         elif not args[1].isnumeric():
             print('Unable to add: id must be numeric.')
         else:
-            remove_anime(load_json(JSON_FILE_PATH), int(args[1]))
+            remove_anime(data, int(args[1]))
             pass
 
     # Updating an anime in the system.
@@ -590,7 +1135,7 @@ def execute(options: optparse.OptionParser):
         elif not args[1].isnumeric():
             print('Unable to add: id must be numeric.')
         else:
-            update_anime(load_json(JSON_FILE_PATH), int(args[1]), args[2])
+            update_anime(data, int(args[1]), args[2])
     
     # Sync anime information from MyAnimeList.net
     elif args[0].lower() == 'sync':
@@ -601,19 +1146,52 @@ def execute(options: optparse.OptionParser):
         elif not args[1].isnumeric():
             print('Unable to sync: id must be numeric.')
         else:
-            api_sync(load_json(JSON_FILE_PATH), int(args[1]))
+            api_sync(data, int(args[1]))
 
     # Remove any anime that are finished.
     elif args[0].lower() == 'clean':
-        clean_list(load_json(JSON_FILE_PATH))
+        clean_list(data)
 
     # Set program options.
     elif args[0].lower() == 'setopt':
-        set_options(options.setopt)
+        if len(args) < 2: # Too few args
+            print('Unable to set options: Missing option string.')
+        elif len(args) > 2: # Too many args
+            print('Unable to set options: Too many arguments')
+        else:
+            setopt = {}
+            for instruction in args[1].split(','):
+                keyval = instruction.split('=')
+                if len(keyval) == 2:
+                    setopt[keyval[0]] = parse_string_value(keyval[1])
+            set_options(data, setopt)
     
+    # Show how far behind each profile is on an anime.
+    elif args[0].lower() == 'behind':
+        if len(args) < 2: # Too few args
+            print('Unable to compare: Missing ID')
+        elif len(args) > 2: # Too many args
+            print('Unable to compare: Too many arguments')
+        elif not args[1].isnumeric():
+            print('Unable to compare: id must be numeric.')
+        else:
+            list_behind(int(args[1]))
+
+    # Export the airing schedule as a calendar and/or feed.
+    elif args[0].lower() == 'export':
+        if len(args) > 1: # Too many args
+            print('Unable to export: Too many arguments')
+        elif not options.ics and not options.rss:
+            print('Unable to export: Missing --ics or --rss output file.')
+        else:
+            export_schedule(data, ics=options.ics, rss=options.rss)
+
     else:
         print(f'Unknown action: {args[0]}\nPlease retry or use the -h flag for help.')
 
+    # Keep the parsed episode numbers for the next run.
+    get_episode_index().save()
+
 #json_data = load_json()
 if __name__ == "__main__":
     parser = optparse.OptionParser(
@@ -634,13 +1212,27 @@ Actions:
   sync:    (sync [id])       Redownloads data for given id. if no id given
                              syncs all tracked anime.
   clean:   (clean)           Removes all completed and saved anime.
+  export:  (export --ics [file] --rss [file])
+                             Exports the airing schedule as an iCalendar
+                             file and/or an RSS feed. Only anime whose
+                             schedule changed since the last export are
+                             regenerated.
+  behind:  (behind [id])      Shows how far behind every profile is on
+                             the given anime.
   setopt   (setopt opt1=val,opt2=val)
                              Sets the options in the given string to the
-                             provided values."""
+                             provided values. Options:
+                               apikey     - MyAnimeList.net api client ID.
+                               timezone   - UTC offset used for air times.
+                               extensions - Space separated video file
+                                            extensions counted as episodes."""
     )
 
     parser.add_option('-a', '--acquired', dest='downloaded', default=-1, type='int', help='number of episodes already acquired.')
     parser.add_option('-i', '--id', dest='id', default='', type='string', help='the index of the listed anime.')
+    parser.add_option('-p', '--profile', dest='profile', default=None, type='string', help='the profile to manage. Uses the default profile if not given.')
+    parser.add_option('--ics', dest='ics', default=None, type='string', help='iCalendar file to export the schedule to.')
+    parser.add_option('--rss', dest='rss', default=None, type='string', help='RSS file to export the schedule to.')
     parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true', help='Enables verbose logging.')
 
     execute(parser)